@@ -25,9 +25,12 @@
 
 
 import os
+import sys
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
 from os.path import dirname
-from subprocess import call
+
+_HERE = dirname(os.path.abspath(__file__))
+_MAIN = os.path.join(dirname(_HERE), "main.py")
 
 parser = ArgumentParser(ArgumentDefaultsHelpFormatter)
 parser.add_argument("--task", type=str, default="01", help="Path to data")
@@ -41,15 +44,14 @@ parser.add_argument("--logname", type=str, default="log", help="Name of dlloger
 
 if __name__ == "__main__":
     args = parser.parse_args()
-    path_to_main = os.path.join(dirname(dirname(os.path.realpath(__file__))), "main.py")
-    cmd = f"python {path_to_main} --exec_mode train --task {args.task} --deep_supervision --save_ckpt "
-    cmd += f"--results {args.results} "
-    cmd += f"--logname {args.logname} "
-    cmd += f"--dim {args.dim} "
-    cmd += f"--batch_size {2 if args.dim == 3 else 64} "
-    cmd += f"--val_batch_size {4 if args.dim == 3 else 64} "
-    cmd += f"--fold {args.fold} "
-    cmd += f"--gpus {args.gpus} "
-    cmd += "--amp " if args.amp else ""
-    cmd += "--tta " if args.tta else ""
-    call(cmd, shell=True)
+    argv = [sys.executable, _MAIN, "--exec_mode", "train", "--task", args.task, "--deep_supervision", "--save_ckpt"]
+    argv += ["--results", args.results]
+    argv += ["--logname", args.logname]
+    argv += ["--dim", str(args.dim)]
+    argv += ["--batch_size", str(2 if args.dim == 3 else 64)]
+    argv += ["--val_batch_size", str(4 if args.dim == 3 else 64)]
+    argv += ["--fold", str(args.fold)]
+    argv += ["--gpus", str(args.gpus)]
+    argv += ["--amp"] if args.amp else []
+    argv += ["--tta"] if args.tta else []
+    os.execv(sys.executable, argv)
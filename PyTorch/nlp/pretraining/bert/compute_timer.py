@@ -1,6 +1,6 @@
 import torch
 import utils
-import time
+from time import monotonic_ns
 from collections import deque
 
 
@@ -9,56 +9,88 @@ class ComputeTimeout(Exception):
 
 
 class DeviceTimer(object):
+    _last_event = None  # most recent event recorded by any timer in the current iteration
+
     def _get_hpu_module(self):
         if self.habana_module is None:
             import habana_frameworks.torch as ht
             self.habana_module = ht
 
-    def __init__(self, use_hpu=False, debug=False, event_sync_delay=9):
+    def __init__(self, use_hpu=False, debug=False, event_sync_delay=9, sync_every=1):
         self.start_time = None
         self.debug = debug
         self.events = deque(maxlen=event_sync_delay+1)  # sync on the previous event according to parameter
+        self._event_pool = []  # events that fell off the deque, already synchronized and safe to re-record
+        self._tick = 0
+        self.sync_every = sync_every  # record/sync only on every n-th call to amortize driver traffic
         self.habana_module = None
         self.use_hpu = use_hpu
         self.enable_drop_compute = False
         self.dropped = False
         self.drop_threshold = 0
-        if (use_hpu):
-            self._get_hpu_module()
+        # resolved on the first sync, the timer is created before the device is set up
+        self._event_cls = None
+        self._stream = None
 
-    def _sync(self):
+    def _init_device(self):
         if self.use_hpu:
-            sync_event = self.habana_module.hpu.Event(enable_timing=True)
-            sync_event.record()
-            self.habana_module.hpu.current_stream().wait_event(sync_event)
+            self._get_hpu_module()
+            self._event_cls = self.habana_module.hpu.Event
+            self._stream = self.habana_module.hpu.current_stream()
         else:
-            sync_event = torch.cuda.Event(enable_timing=True)
-            sync_event.record()
-            torch.cuda.current_stream().wait_event(sync_event)
+            self._event_cls = torch.cuda.Event
+            self._stream = torch.cuda.current_stream()
+
+    def _new_event(self):
+        if self._event_pool:
+            return self._event_pool.pop()
+        return self._event_cls(enable_timing=False)
 
+    def _sync(self):
+        self._tick += 1
+        if self._tick % self.sync_every:
+            return
+        if self._stream is None:
+            self._init_device()
+        sync_event = self._new_event()
+        sync_event.record(self._stream)
+
+        if len(self.events) == self.events.maxlen:
+            # the oldest event completed (queried or synchronized) on the previous call, recycle it
+            self._event_pool.append(self.events.popleft())
         self.events.append(sync_event)
-        wait_event = self.events[0]
-        wait_event.synchronize()
+        DeviceTimer._last_event = sync_event
+        if len(self.events) == self.events.maxlen:
+            # only block when the device is more than event_sync_delay events behind
+            wait_event = self.events[0]
+            if not wait_event.query():
+                wait_event.synchronize()
         #self.habana_module.hpu.current_stream().synchronize()
 
+    @classmethod
+    def begin_iteration(cls):
+        cls._last_event = None
+
     def start(self):
-        self._sync()
-        self.start_time = time.time()
+        # an event recorded earlier in this iteration already snapshots the stream, no need for another one
+        if DeviceTimer._last_event is None:
+            self._sync()
+        self.start_time = monotonic_ns()
 
     def elapsed(self):
         if self.start_time is None:
             return 0
         self._sync()
-        return time.time() - self.start_time
+        return (monotonic_ns() - self.start_time) * 1e-9
 
     def check_drop_compute_throw(self, name=""):
-        if not self.is_started():
+        if not self.enable_drop_compute or not self.is_started():
             return False
 
         current_time = self.elapsed()
         #if utils.is_main_process():
         #    print(f"current_time: {current_time}, global_drop_threshold: {self.drop_threshold}, global_enable_drop_compute {self.enable_drop_compute}")
-        if self.enable_drop_compute and (current_time > self.drop_threshold):
+        if current_time > self.drop_threshold:
             self.dropped = True
             if self.debug:
                 print(f"reached timeout with module: {name}. current_time: {current_time}, global_drop_threshold: {self.drop_threshold}")
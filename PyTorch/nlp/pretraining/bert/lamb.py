@@ -68,6 +68,9 @@ class NVLAMB(Optimizer):
             (default: 1.0)
         use_nvlamb (boolean, optional): Apply adaptive learning rate to 0.0
             weight decay parameter (default: False)
+        foreach (boolean, optional): update all the parameters of a group with
+            multi-tensor (foreach) ops instead of one parameter at a time,
+            None selects it when available (default: None)
 
     .. _Large Batch Optimization for Deep Learning - Training BERT in 76 minutes:
         https://arxiv.org/abs/1904.00962
@@ -78,7 +81,7 @@ class NVLAMB(Optimizer):
                  betas=(0.9, 0.999), eps=1e-6, weight_decay=0.01,
                  amsgrad=False, adam_w_mode=True,
                  grad_averaging=True, set_grad_none=True,
-                 max_grad_norm=1.0, use_nvlamb=False,fused=False):
+                 max_grad_norm=1.0, use_nvlamb=False,fused=False, foreach=None):
         if amsgrad:
             raise RuntimeError('NVLAMB does not support the AMSGrad variant.')
         defaults = dict(lr=lr, bias_correction=bias_correction,
@@ -90,14 +93,19 @@ class NVLAMB(Optimizer):
         self.adam_w_mode = 1 if adam_w_mode else 0 # dummy for now, always use adam_w mode (wd is excluded from EMA)
         self.set_grad_none = set_grad_none
         self.use_nvlamb = use_nvlamb
+        if foreach is None:
+            foreach = hasattr(torch, '_foreach_norm')
+        self.foreach = foreach
 
-    def zero_grad(self):
-        if self.set_grad_none:
+    def zero_grad(self, set_to_none=None):
+        if set_to_none is None:
+            set_to_none = self.set_grad_none
+        if set_to_none:
             for group in self.param_groups:
                 for p in group['params']:
                     p.grad = None
         else:
-            super(NVLAMB, self).zero_grad()
+            super(NVLAMB, self).zero_grad(set_to_none=False)
 
     def step(self, closure=None):
         """Performs a single optimization step.
@@ -111,6 +119,11 @@ class NVLAMB(Optimizer):
         if closure is not None:
             loss = closure()
 
+        if self.foreach:
+            with torch.no_grad():
+                self._foreach_step()
+            return loss
+
         global_grad_norm = torch.zeros(1, device=device)
         for group in self.param_groups:
             for p in group['params']:
@@ -200,3 +213,81 @@ class NVLAMB(Optimizer):
                 alpha = -step_size * trust_ratio
                 adam_step2 = adam_step * alpha
                 p.data.add_(adam_step2)
+
+        return loss
+
+    def _foreach_step(self):
+        grads = []
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                if p.grad.is_sparse:
+                    raise RuntimeError('Lamb does not support sparse gradients, consider SparseAdam instad.')
+                grads.append(p.grad)
+        if not grads:
+            return
+
+        # the clipping and trust ratios stay on device, no host sync per parameter
+        global_grad_norm = torch.linalg.vector_norm(torch.stack(torch._foreach_norm(grads)))
+        clip_global_grad_norm = (global_grad_norm / self.defaults['max_grad_norm']).clamp_(min=1.0)
+
+        for group in self.param_groups:
+            params = [p for p in group['params'] if p.grad is not None]
+            if not params:
+                continue
+            grads = [p.grad for p in params]
+            beta1, beta2 = group['betas']
+            beta3 = 1 - beta1 if group['grad_averaging'] else 1.0
+
+            if 'step' in group:
+                group['step'] += 1
+            else:
+                group['step'] = 1
+
+            if group['bias_correction']:
+                bias_correction1 = 1 - beta1 ** group['step']
+                bias_correction2 = 1 - beta2 ** group['step']
+            else:
+                bias_correction1, bias_correction2 = 1.0, 1.0
+
+            for p in params:
+                state = self.state[p]
+                if len(state) == 0:
+                    state['exp_avg'] = torch.zeros_like(p)
+                    state['exp_avg_sq'] = torch.zeros_like(p)
+            exp_avgs = [self.state[p]['exp_avg'] for p in params]
+            exp_avg_sqs = [self.state[p]['exp_avg_sq'] for p in params]
+
+            torch._foreach_div_(grads, [clip_global_grad_norm] * len(grads))
+            # m_t
+            torch._foreach_mul_(exp_avgs, beta1)
+            torch._foreach_add_(exp_avgs, grads, alpha=beta3)
+            # v_t
+            torch._foreach_mul_(exp_avg_sqs, beta2)
+            torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+
+            # u_t
+            adam_steps = torch._foreach_div(exp_avgs, bias_correction1)
+            denoms = torch._foreach_div(exp_avg_sqs, bias_correction2)
+            torch._foreach_sqrt_(denoms)
+            torch._foreach_add_(denoms, group['eps'])
+            torch._foreach_div_(adam_steps, denoms)
+            if group['weight_decay'] != 0:
+                torch._foreach_add_(adam_steps, params, alpha=group['weight_decay'])
+
+            if group['weight_decay'] != 0 or self.use_nvlamb:
+                weight_norms = torch.stack(torch._foreach_norm(params))
+                adam_norms = torch.stack(torch._foreach_norm(adam_steps))
+                trust_ratios = torch.where((weight_norms > 0) & (adam_norms > 0),
+                                           weight_norms / adam_norms,
+                                           torch.ones_like(weight_norms))
+                torch._foreach_mul_(adam_steps, list(trust_ratios.unbind()))
+                for p, weight_norm, adam_norm, trust_ratio in zip(
+                        params, weight_norms, adam_norms, trust_ratios):
+                    state = self.state[p]
+                    state['weight_norm'] = weight_norm
+                    state['adam_norm'] = adam_norm
+                    state['trust_ratio'] = trust_ratio
+
+            torch._foreach_add_(params, adam_steps, alpha=-group['lr'])
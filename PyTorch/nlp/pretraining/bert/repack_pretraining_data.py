@@ -0,0 +1,98 @@
+###############################################################################
+# Copyright (c) 2021, Habana Labs Ltd.  All rights reserved.
+###############################################################################
+import os
+import time
+import shutil
+import argparse
+import h5py
+import numpy as np
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+
+def get_compression_kwargs(compression):
+    if compression == 'lz4':
+        if hdf5plugin is None:
+            raise ImportError("lz4 compression requires hdf5plugin, "
+                              "please install it with 'pip install hdf5plugin'")
+        return dict(hdf5plugin.LZ4(), shuffle=True)
+    if compression == 'gzip':
+        return dict(compression='gzip', shuffle=True)
+    return {}
+
+
+def repack_file(args, input_file):
+    output_file = os.path.join(args.output_dir, os.path.basename(input_file))
+    compression_kwargs = get_compression_kwargs(args.compression)
+    with h5py.File(input_file, 'r') as fin, h5py.File(output_file, 'w') as fout:
+        for key, dset in fin.items():
+            data = np.empty(dset.shape, dset.dtype)
+            dset.read_direct(data)
+            # chunk along rows only so a chunk holds whole samples
+            chunks = (min(args.chunk_rows, data.shape[0]),) + data.shape[1:]
+            fout.create_dataset(key, data=data, chunks=chunks,
+                                **compression_kwargs)
+        fout.attrs['chunk_rows'] = args.chunk_rows
+        fout.attrs['compression'] = args.compression
+    return output_file
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    ## Required parameters
+    parser.add_argument("--input_dir",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="The input data dir. Should contain .hdf5 files for the task.")
+    parser.add_argument("--output_dir",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="The output directory where the repacked dataset will be written.")
+    parser.add_argument("--chunk_rows",
+                        default=1024,
+                        type=int,
+                        help="Number of samples stored in a single HDF5 chunk.")
+    parser.add_argument("--compression",
+                        default='lz4',
+                        choices=['lz4', 'gzip', 'none'],
+                        help="Compression filter of the repacked datasets. lz4 requires hdf5plugin.")
+    parser.add_argument("--num_workers",
+                        default=8,
+                        type=int,
+                        help="Number of files repacked in parallel.")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_arguments()
+    # fail early instead of inside the worker processes
+    get_compression_kwargs(args.compression)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    files = sorted(os.path.join(args.input_dir, f) for f in os.listdir(args.input_dir) if
+                   os.path.isfile(os.path.join(args.input_dir, f)))
+    print(f"Repacking {len(files)} files from {args.input_dir} to {args.output_dir}.")
+
+    start = time.time()
+    with ProcessPoolExecutor(args.num_workers) as executor:
+        for output_file in executor.map(repack_file, repeat(args), files):
+            print(f"-- wrote {output_file}")
+
+    # packed datasets keep their metadata next to the data directory
+    input_metadata = os.path.normpath(args.input_dir) + '_metadata.json'
+    if os.path.exists(input_metadata):
+        shutil.copyfile(input_metadata, os.path.normpath(args.output_dir) + '_metadata.json')
+    print(f"\nDone. Took: {time.time() - start:3.2f} seconds to repack dataset.")
+
+
+if __name__ == "__main__":
+    main()
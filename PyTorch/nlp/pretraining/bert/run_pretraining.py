@@ -12,7 +12,9 @@ from __future__ import print_function
 
 import argparse
 import collections
+import copy
 import dataclasses
+import functools
 import re
 import dllogger
 import h5py
@@ -24,7 +26,7 @@ import pandas as pd
 from tqdm import tqdm
 from typing import Union, Optional
 import json
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import random
 import signal
 import warnings
@@ -32,6 +34,7 @@ import warnings
 import torch
 import torch.distributed
 import torch.distributed.optim
+import torch.nn.functional as F
 from torch.utils.data import Dataset
 
 import modeling
@@ -43,20 +46,26 @@ from compute_timer import DeviceTimer
 from compute_timer import ComputeTimeout
 
 try:
-    import apex
-    from apex import amp
-    from apex.optimizers import FusedLAMB
-    from apex.parallel import DistributedDataParallel as DDP
-    from apex.parallel.distributed import flat_dist_call
-    import amp_C
-    import apex_C
-    from apex.amp import _amp_state
+    # registers the LZ4 filter used by repack_pretraining_data.py shards
+    import hdf5plugin
 except ImportError:
-    if torch.cuda.is_available():
+    pass
+
+if torch.cuda.is_available():
+    try:
+        import apex
+        from apex import amp
+        from apex.optimizers import FusedLAMB
+        from apex.parallel import DistributedDataParallel as DDP
+        from apex.parallel.distributed import flat_dist_call
+        import amp_C
+        import apex_C
+        from apex.amp import _amp_state
+    except ImportError:
         raise ImportError("Please install apex from "
                           "https://www.github.com/nvidia/apex")
-    else:
-        from torch.nn.parallel import DistributedDataParallel as DDP
+else:
+    from torch.nn.parallel import DistributedDataParallel as DDP
 
 
 try:
@@ -65,9 +74,6 @@ except ImportError:
     assert False, "Could not import habana_frameworks.torch"
 
 
-torch._C._jit_set_profiling_mode(False)
-torch._C._jit_set_profiling_executor(False)
-
 skipped_steps = 0
 avg_seq_per_pack = 1.0
 
@@ -86,22 +92,30 @@ signal.signal(signal.SIGTERM, signal_handler)
 
 # Workaround because python functions are not picklable
 class WorkerInitObj(object):
-    def __init__(self, seed):
+    def __init__(self, seed, cpu_affinity=None):
         self.seed = seed
+        self.cpu_affinity = cpu_affinity
 
     def __call__(self, idx):
         np.random.seed(self.seed + idx)
         random.seed(self.seed + idx)
+        if self.cpu_affinity is not None:
+            os.sched_setaffinity(0, self.cpu_affinity)
 
 
 def create_pretraining_dataset(input_file, max_pred_length, shared_list, args,
                                worker_init):
-    num_workers = 0 if args.use_habana else 4
+    num_workers = args.num_dl_workers
+    # prefetch_factor may only be passed together with worker processes
+    loader_kwargs = {'prefetch_factor': 4} if num_workers > 0 else {}
     train_data = PretrainingDataset(
         input_file=input_file,
         max_pred_length=max_pred_length,
         enable_packed_data_mode=args.enable_packed_data_mode
     )
+    if num_workers > 0:
+        train_data.share_memory()
+    pin_memory_device = 'hpu' if args.use_habana else ''
     train_sampler = torch.utils.data.RandomSampler(train_data)
     train_dataloader = torch.utils.data.DataLoader(
         train_data,
@@ -109,18 +123,168 @@ def create_pretraining_dataset(input_file, max_pred_length, shared_list, args,
         batch_size=args.train_batch_size * args.n_pu,
         num_workers=num_workers,
         worker_init_fn=worker_init,
+        collate_fn=PretrainingBatchCollator(train_data.output_keys,
+                                            pin_memory_device),
         drop_last=True,
-        pin_memory=True
+        pin_memory=True,
+        pin_memory_device=pin_memory_device,
+        **loader_kwargs
     )
     return train_dataloader, input_file
 
 
+@dataclasses.dataclass
+class PretrainingBatch:
+    input_ids: torch.Tensor
+    segment_ids: torch.Tensor
+    input_mask: torch.Tensor
+    masked_lm_labels: torch.Tensor
+    next_sentence_labels: torch.Tensor
+    positions: Optional[torch.Tensor] = None
+    next_sentence_positions: Optional[torch.Tensor] = None
+    pin_memory_device: str = ''
+    # (field names, pinned buffer) per dtype, the fields are views into it
+    flat_tensors: Optional[list] = dataclasses.field(default=None, repr=False)
+
+    def tensors(self):
+        return {field.name: getattr(self, field.name)
+                for field in dataclasses.fields(self)
+                if isinstance(getattr(self, field.name), torch.Tensor)}
+
+    def pin_memory(self):
+        """Pins the batch with a single host allocation per dtype."""
+        tensors = self.tensors()
+        pinned = {}
+        flat_tensors = []
+        for dtype in {tensor.dtype for tensor in tensors.values()}:
+            names = [name for name, tensor in tensors.items()
+                     if tensor.dtype == dtype]
+            flat = torch.cat([tensors[name].reshape(-1) for name in names])
+            if self.pin_memory_device:
+                flat = flat.pin_memory(self.pin_memory_device)
+            else:
+                flat = flat.pin_memory()
+            flat_tensors.append((names, flat))
+            chunks = flat.split([tensors[name].numel() for name in names])
+            for name, chunk in zip(names, chunks):
+                pinned[name] = chunk.view_as(tensors[name])
+        return dataclasses.replace(self, flat_tensors=flat_tensors, **pinned)
+
+    def to(self, device, non_blocking=False):
+        """Copies the batch to device and promotes it to int64 there.
+
+        A pinned batch is copied with a single transfer per dtype.
+        """
+        tensors = self.tensors()
+        if self.flat_tensors is None:
+            return dataclasses.replace(self, **{
+                name: tensor.to(device, non_blocking=non_blocking).long()
+                for name, tensor in tensors.items()})
+        moved = {}
+        for names, flat in self.flat_tensors:
+            flat = flat.to(device, non_blocking=non_blocking).long()
+            chunks = flat.split([tensors[name].numel() for name in names])
+            for name, chunk in zip(names, chunks):
+                moved[name] = chunk.view_as(tensors[name])
+        return dataclasses.replace(self, flat_tensors=None, **moved)
+
+
+class PretrainingBatchCollator(object):
+    def __init__(self, keys, pin_memory_device=''):
+        self.keys = keys
+        self.pin_memory_device = pin_memory_device
+
+    def __call__(self, samples):
+        fields = {key: torch.stack(tensors)
+                  for key, tensors in zip(self.keys, zip(*samples))}
+        return PretrainingBatch(pin_memory_device=self.pin_memory_device,
+                                **fields)
+
+
+class DevicePrefetcher(object):
+    """Iterates a DataLoader yielding its batches already on device.
+
+    On CUDA the next batch is copied on a side stream while the current one
+    is being computed. Other devices copy each batch asynchronously when it
+    is requested, so the copy is not recorded into the previous step.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream() if device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self, batch):
+        with torch.cuda.stream(self.stream):
+            batch = batch.to(self.device, non_blocking=True)
+            ready = torch.cuda.Event()
+            ready.record(self.stream)
+        return batch, ready
+
+    def _wait(self, batch, ready):
+        current_stream = torch.cuda.current_stream()
+        current_stream.wait_event(ready)
+        # the memory was allocated on the copy stream
+        for tensor in batch.tensors().values():
+            tensor.record_stream(current_stream)
+        return batch
+
+    def __iter__(self):
+        if self.stream is None:
+            for batch in self.loader:
+                yield batch.to(self.device, non_blocking=True)
+            return
+        preloaded = None
+        for batch in self.loader:
+            batch = self._preload(batch)
+            if preloaded is not None:
+                yield self._wait(*preloaded)
+            preloaded = batch
+        if preloaded is not None:
+            yield self._wait(*preloaded)
+
+
+class ShardPrefetcher(object):
+    """Creates the DataLoaders of upcoming shards in the background."""
+
+    def __init__(self, executor, prefetch, max_pred_length, shared_list,
+                 args, worker_init):
+        self.executor = executor
+        self.prefetch = prefetch
+        self.max_pred_length = max_pred_length
+        self.shared_list = shared_list
+        self.args = args
+        self.worker_init = worker_init
+        self.futures = collections.OrderedDict()
+
+    def submit(self, f_id, input_file):
+        if f_id not in self.futures:
+            self.futures[f_id] = self.executor.submit(
+                create_pretraining_dataset, input_file, self.max_pred_length,
+                self.shared_list, self.args, self.worker_init)
+
+    def get(self, f_id):
+        """Returns (train_dataloader, input_file) of f_id, blocks until loaded."""
+        return self.futures.pop(f_id).result(timeout=None)
+
+
+def get_shard_schedule(files, num_files):
+    """Returns the file this rank trains on for every f_id of the epoch."""
+    world_size = utils.get_world_size()
+    rank = utils.get_rank()
+    remainder = world_size % num_files if world_size > num_files else 0
+    return [files[(f_id * world_size + rank + remainder * f_id) % num_files]
+            for f_id in range(len(files))]
+
+
 class PretrainingDataset(torch.utils.data.Dataset):
     def __init__(self, input_file, max_pred_length,
                  enable_packed_data_mode: bool = False):
         self.input_file = input_file
         self.max_pred_length = max_pred_length
-        f = h5py.File(input_file, "r")
         if enable_packed_data_mode:
             keys = ['input_ids', 'input_mask', 'segment_ids', 'positions',
                     'masked_lm_positions', 'masked_lm_ids',
@@ -130,81 +294,83 @@ class PretrainingDataset(torch.utils.data.Dataset):
             keys = ['input_ids', 'input_mask', 'segment_ids',
                     'masked_lm_positions', 'masked_lm_ids',
                     'next_sentence_labels']
-        self.inputs = [np.asarray(f[key][:]) for key in keys]
-        f.close()
+        data = {}
+        # large chunk cache so every compressed chunk is decoded once
+        with h5py.File(input_file, "r", rdcc_nbytes=256 * 1024 * 1024,
+                       rdcc_nslots=1_000_003) as f:
+            for key in keys:
+                dset = f[key]
+                # read straight into a preallocated array in the on-disk
+                # dtype (int32 or narrower)
+                arr = np.empty(dset.shape, dset.dtype)
+                dset.read_direct(arr)
+                data[key] = arr
+        if enable_packed_data_mode:
+            # unused next sentence slots are ignored by the loss
+            weights = data.pop('next_sentence_weights')
+            data['next_sentence_labels'] = np.where(
+                weights == 1, data['next_sentence_labels'], -1)
+        # number of masked tokens per sample, positions are left aligned
+        # and padded with zeros
+        masked_lm_positions = data.pop('masked_lm_positions')
+        masked_lm_ids = data.pop('masked_lm_ids')
+        # index of the first padding zero, full width when there is none
+        nonzero = masked_lm_positions != 0
+        n_masked = np.where(nonzero.all(axis=1), masked_lm_positions.shape[1],
+                            nonzero.argmin(axis=1)).astype(np.int32)
+        # scatter the masked token ids of the whole shard at once
+        rows, cols = np.nonzero(
+            np.arange(masked_lm_positions.shape[1]) < n_masked[:, None])
+        masked_lm_labels = np.full(data['input_ids'].shape, -1, dtype=np.int32)
+        masked_lm_labels[rows, masked_lm_positions[rows, cols]] = (
+            masked_lm_ids[rows, cols])
+        data['masked_lm_labels'] = masked_lm_labels
+
+        if enable_packed_data_mode:
+            output_keys = ['input_ids', 'segment_ids', 'input_mask',
+                           'positions', 'masked_lm_labels',
+                           'next_sentence_positions', 'next_sentence_labels']
+        else:
+            output_keys = ['input_ids', 'segment_ids', 'input_mask',
+                           'masked_lm_labels', 'next_sentence_labels']
+        # stored in the order returned by __getitem__, keeping the on-disk
+        # int32 (or narrower) dtypes to halve host to device traffic, the
+        # training loop promotes to int64 on the device
+        self.inputs = [torch.from_numpy(data[key]) for key in output_keys]
+        self.output_keys = output_keys
         self.enable_packed_data_mode = enable_packed_data_mode
 
+    def share_memory(self):
+        """Moves the shard into shared memory so workers map one copy."""
+        for tensor in self.inputs:
+            tensor.share_memory_()
+        return self
+
     def __len__(self):
         """Denotes the total number of samples."""
         return len(self.inputs[0])
 
     def __getitem__(self, index):
-        if self.enable_packed_data_mode:
-            [
-                input_ids,
-                input_mask,
-                segment_ids,
-                positions,
-                masked_lm_positions,
-                masked_lm_ids,
-                next_sentence_positions,
-                next_sentence_labels,
-                next_sentence_weights
-            ] = [torch.from_numpy(
-                sample[index].astype(np.int64)) for sample in self.inputs]
-        else:
-            [
-                input_ids,
-                input_mask,
-                segment_ids,
-                masked_lm_positions,
-                masked_lm_ids,
-                next_sentence_labels
-            ] = [torch.from_numpy(sample[index].astype(np.int64)) if indice < 5 else torch.from_numpy(np.asarray(sample[index].astype(np.int64))) for indice, sample in enumerate(self.inputs)]
-
-        masked_lm_labels = torch.ones(input_ids.shape, dtype=torch.long) * -1
-        index = self.max_pred_length
-        # store number of  masked tokens in index
-        padded_mask_indices = (masked_lm_positions == 0).nonzero()
-        if len(padded_mask_indices) != 0:
-            index = padded_mask_indices[0].item()
-        masked_lm_labels[masked_lm_positions[:index]] = masked_lm_ids[:index]
-
-        if self.enable_packed_data_mode:
-            next_sentence_labels = (next_sentence_weights == 1) * next_sentence_labels + (next_sentence_weights == 0) * -1
-            return [input_ids,
-                    segment_ids,
-                    input_mask,
-                    positions,
-                    masked_lm_labels,
-                    next_sentence_positions,
-                    next_sentence_labels]
-        else:
-            return [input_ids,
-                    segment_ids,
-                    input_mask,
-                    masked_lm_labels,
-                    next_sentence_labels]
+        return [tensor[index] for tensor in self.inputs]
 
 
 class BertPretrainingCriterion(torch.nn.Module):
     def __init__(self, vocab_size):
         super(BertPretrainingCriterion, self).__init__()
-        self.loss_fn = torch.nn.CrossEntropyLoss(ignore_index=-1)
         self.vocab_size = vocab_size
 
     def forward(self, prediction_scores, seq_relationship_score,
                 masked_lm_labels, next_sentence_labels):
-        masked_lm_loss = self.loss_fn(
-            prediction_scores.view(-1, self.vocab_size),
-            masked_lm_labels.view(-1)
-        )
-        next_sentence_loss = self.loss_fn(
-            seq_relationship_score.view(-1, 2),
-            next_sentence_labels.view(-1)
+        # reshape only copies when the scores are not contiguous
+        return F.cross_entropy(
+            prediction_scores.reshape(-1, self.vocab_size),
+            masked_lm_labels.reshape(-1),
+            ignore_index=-1
+        ) + F.cross_entropy(
+            seq_relationship_score.reshape(-1, 2),
+            next_sentence_labels.reshape(-1),
+            ignore_index=-1
         )
-        total_loss = masked_lm_loss + next_sentence_loss
-        return total_loss
 
 
 @dataclasses.dataclass
@@ -214,6 +380,8 @@ class ComputeState:
     threshold: float = 0
     enable_drop: bool = False
     mini_batch_size: int = 0
+    # host copy of this rank's computed_batch_size before the allreduce
+    local_computed_batch_size: int = 0
 
     def __init__(self, device: Union[int, torch.device]):
         self.computed_batch_size = torch.zeros(1, device=device)
@@ -225,6 +393,37 @@ class ComputeState:
         self.start_compute = start_compute
         self.mini_batch_size = mini_batch_size
         self.computed_batch_size.zero_()
+        self.local_computed_batch_size = 0
+
+
+class ComputeLogs:
+    """Per micro-batch compute logs, stored column-wise in preallocated arrays."""
+    columns = (('global_step', np.int64),
+               ('local_step', np.int32),
+               ('world_size', np.int32),
+               ('batch', np.int32),
+               ('sentence_length', np.int32),
+               ('computed_batch', np.int64),
+               ('compute_dropped', np.bool_),
+               ('fwd_start', np.float64),
+               ('step_end', np.float64))
+
+    def __init__(self, capacity: int):
+        self.size = 0
+        self.logs = {name: np.empty(max(capacity, 1), dtype=dtype)
+                     for name, dtype in self.columns}
+
+    def append(self, **values):
+        if self.size == len(self.logs['global_step']):
+            for name, column in self.logs.items():
+                self.logs[name] = np.resize(column, 2 * len(column))
+        for name, value in values.items():
+            self.logs[name][self.size] = value
+        self.size += 1
+
+    def to_csv(self):
+        return pd.DataFrame({name: column[:self.size]
+                             for name, column in self.logs.items()}).to_csv()
 
 
 def parse_arguments():
@@ -419,6 +618,40 @@ def parse_arguments():
                         type=float,
                         help='Stop FWD/BWD when the threshold is reached.'
                              ' units in seconds')
+    parser.add_argument('--drop_compute_sync_every',
+                        type=int,
+                        default=8,
+                        help='Record and wait on a device event only on every'
+                             ' n-th drop compute timer sync, the other checks'
+                             ' use the host clock alone')
+    parser.add_argument('--num_dl_workers',
+                        type=int,
+                        default=-1,
+                        help='Number of DataLoader worker processes. -1 uses'
+                             ' min(8, cpu_count // processes per node)')
+    parser.add_argument('--allreduce_bucket_cap_mb',
+                        type=float,
+                        default=0,
+                        help='Bucket size in MB for overlapping the post'
+                             ' accumulation gradient allreduce with the last'
+                             ' backward pass on HPU. 0 allreduces all'
+                             ' gradients after the backward pass')
+    parser.add_argument('--allreduce_reduce_scatter',
+                        action='store_true',
+                        help='Reduce the post accumulation gradients on HPU'
+                             ' with reduce_scatter and all_gather instead of'
+                             ' all_reduce. Applies to gradients larger than'
+                             ' 1MB that are not bucketed')
+    parser.add_argument('--prefetch_shards',
+                        type=int,
+                        default=2,
+                        help='Number of upcoming data shards loaded in the'
+                             ' background while the current one trains,'
+                             ' should be >= 1')
+    parser.add_argument('--bind_numa',
+                        action='store_true',
+                        help='Bind the training process and its DataLoader'
+                             ' workers to the NUMA node of the accelerator')
     parser.add_argument('--debug',
                         action='store_true',
                         help='Debug mode. print more data related to drop'
@@ -434,22 +667,129 @@ def parse_arguments():
     return args
 
 
-def unflatten_tensor(flat, tensor_list):
-    outputs = []
-    offset = 0
-    for tensor in tensor_list:
-        numel = tensor.numel()
-        outputs.append(flat.narrow(0, offset, numel).view_as(tensor))
-        offset += numel
-    return outputs
-
+class FlatGradientBuffer(object):
+    """Persistent flat buffer the gradients are allreduced through.
+
+    The .grad of every parameter is a view into the buffer, so backward
+    accumulates straight into it and the buffer is zeroed instead of the
+    gradients being released after each optimizer step.
+
+    With bucket_cap_mb > 0 the buffer is split into buckets in backward order
+    and, once armed for the last micro-batch, every bucket is allreduced
+    asynchronously as soon as the backward pass has produced all its
+    gradients, overlapping communication with the rest of the backward pass.
+
+    With reduce_scatter the unbucketed buffer is reduced with a
+    reduce_scatter followed by an all_gather instead of an all_reduce.
+    """
+    # smaller buffers are latency bound, a single all_reduce is cheaper
+    REDUCE_SCATTER_MIN_BYTES = 1024 * 1024
+
+    def __init__(self, params, divisor, bucket_cap_mb=0, reduce_scatter=False):
+        self.params = [param for param in params if param.requires_grad]
+        self.divisor = divisor
+        numel = sum(param.numel() for param in self.params)
+        dtype = self.params[0].dtype
+        world_size = torch.distributed.get_world_size()
+        self.shard = None
+        if (reduce_scatter and world_size > 1 and
+                hasattr(torch.distributed, 'reduce_scatter_tensor') and
+                hasattr(torch.distributed, 'all_gather_into_tensor') and
+                numel * torch.finfo(dtype).bits // 8 > self.REDUCE_SCATTER_MIN_BYTES):
+            # every rank reduces an equally sized shard of the padded buffer
+            shard_numel = -(-numel // world_size)
+            numel = shard_numel * world_size
+            self.shard = torch.empty(shard_numel, dtype=dtype,
+                                     device=self.params[0].device)
+        self.flat = torch.zeros(numel, dtype=dtype,
+                                device=self.params[0].device)
+        self.views = torch._utils._unflatten_dense_tensors(self.flat, self.params)
+        for param, view in zip(self.params, self.views):
+            param.grad = view
+        self.armed = False
+        self.buckets = []
+        if bucket_cap_mb > 0:
+            self._build_buckets(bucket_cap_mb)
+
+    def _build_buckets(self, bucket_cap_mb):
+        if not hasattr(torch.Tensor, 'register_post_accumulate_grad_hook'):
+            warnings.warn('gradient bucketing needs '
+                          'register_post_accumulate_grad_hook, allreduce is '
+                          'not overlapped with backward')
+            return
+        offsets = [0]
+        for param in self.params:
+            offsets.append(offsets[-1] + param.numel())
+        cap = int(bucket_cap_mb * 1024 * 1024) // self.flat.element_size()
+        # gradients become ready roughly in reverse order of the parameters
+        indices = []
+        for index in reversed(range(len(self.params))):
+            indices.append(index)
+            if offsets[indices[0] + 1] - offsets[index] >= cap or index == 0:
+                self.buckets.append((offsets[index], offsets[indices[0] + 1],
+                                     indices))
+                indices = []
+        self.bucket_of = {}
+        for bucket, (_, _, indices) in enumerate(self.buckets):
+            for index in indices:
+                self.bucket_of[index] = bucket
+                self.params[index].register_post_accumulate_grad_hook(
+                    functools.partial(self._on_grad_ready, index))
+
+    def arm(self):
+        """Overlaps the allreduce with the backward pass of the next micro-batch."""
+        if not self.buckets:
+            return
+        self.armed = True
+        self.done = [False] * len(self.params)
+        self.ready = [0] * len(self.buckets)
+        self.next_bucket = 0
+        self.handles = []
+
+    def _on_grad_ready(self, index, param):
+        if not self.armed or self.done[index]:
+            return
+        self.done[index] = True
+        self.ready[self.bucket_of[index]] += 1
+        # collectives have to be issued in the same order on every rank
+        while (self.next_bucket < len(self.buckets) and
+               self.ready[self.next_bucket] == len(self.buckets[self.next_bucket][2])):
+            self._launch(self.next_bucket)
+            self.next_bucket += 1
+
+    def _launch(self, bucket):
+        start, end, _ = self.buckets[bucket]
+        chunk = self.flat[start:end]
+        chunk.div_(self.divisor)
+        self.handles.append(
+            torch.distributed.all_reduce(chunk, async_op=True))
+
+    def allreduce(self):
+        if self.armed:
+            # buckets whose gradients were not all produced, e.g. on dropped compute
+            for bucket in range(self.next_bucket, len(self.buckets)):
+                self._launch(bucket)
+            for handle in self.handles:
+                handle.wait()
+            self.armed = False
+        elif self.buckets:
+            # not armed when compute was dropped before the last micro-batch,
+            # the other ranks still reduce bucket by bucket
+            self.handles = []
+            for bucket in range(len(self.buckets)):
+                self._launch(bucket)
+            for handle in self.handles:
+                handle.wait()
+        else:
+            self.flat.div_(self.divisor)
+            if self.shard is None:
+                torch.distributed.all_reduce(self.flat)
+            else:
+                torch.distributed.reduce_scatter_tensor(self.shard, self.flat)
+                torch.distributed.all_gather_into_tensor(self.flat, self.shard)
 
-def update_tensors(grad_tensors, outputs):
-    idx=0
-    for grad in grad_tensors:
-        grad.copy_(outputs[idx])
-        idx+=1
-    return outputs
+    def zero_(self):
+        self.flat.zero_()
 
 
 def setup_training(args):
@@ -525,10 +865,19 @@ def setup_training(args):
         raise ValueError('Invalid gradient_accumulation_steps parameter: '
                          f'{args.gradient_accumulation_steps}, batch size '
                          f'{args.train_batch_size} should be divisible')
+    if args.prefetch_shards < 1:
+        raise ValueError('Invalid prefetch_shards parameter: '
+                         f'{args.prefetch_shards}, should be >= 1')
 
     args.train_batch_size = (
             args.train_batch_size // args.gradient_accumulation_steps)
 
+    if args.num_dl_workers < 0:
+        # every local rank spawns its own workers, share the node's cpus between them
+        local_size = int(os.getenv('LOCAL_WORLD_SIZE',
+                                   os.getenv('OMPI_COMM_WORLD_LOCAL_SIZE', args.n_pu)))
+        args.num_dl_workers = min(8, os.cpu_count() // max(local_size, 1))
+
     if args.enable_packed_data_mode:
         args.gradient_accumulation_steps = round(
             args.gradient_accumulation_steps / avg_seq_per_pack)
@@ -555,18 +904,19 @@ def set_hooks(module, models_to_hook):
         assert False, "Could Not import habana_frameworks.torch.core"
 
     def get_hook_func(module_name: str):
-        def log_time(*args):
+        def log_time(module, inputs, output):
             htcore.mark_step()
             global_drop_timer.check_drop_compute_throw(module_name)
         return log_time
 
     expression = re.compile("|".join(models_to_hook))
-    for name, module in module.named_modules():
-        if expression.fullmatch(name) is not None:
-            if utils.is_main_process():
-                print(f"Hooking module: {name}")
-            module.register_forward_hook(get_hook_func('_'.join([name, 'fwd'])))
-            #module.register_backward_hook(get_hook_func('_'.join([name, 'bwd'])))
+    matched = [(name, m) for name, m in module.named_modules()
+               if expression.fullmatch(name) is not None]
+    for name, module in matched:
+        if utils.is_main_process():
+            print(f"Hooking module: {name}")
+        module.register_forward_hook(get_hook_func('_'.join([name, 'fwd'])))
+        #module.register_backward_hook(get_hook_func('_'.join([name, 'bwd'])))
 
 
 def prepare_model_and_optimizer(args, device):
@@ -617,9 +967,14 @@ def prepare_model_and_optimizer(args, device):
     param_optimizer = list(model.named_parameters())
     no_decay = ['bias', 'gamma', 'beta', 'LayerNorm']
 
+    no_decay_expression = re.compile('|'.join(map(re.escape, no_decay)))
+    decay_params, no_decay_params = [], []
+    for n, p in param_optimizer:
+        (no_decay_params if no_decay_expression.search(n) else decay_params).append(p)
+
     optimizer_grouped_parameters = [
-        {'params': [p for n, p in param_optimizer if not any(nd in n for nd in no_decay)], 'weight_decay': 0.01},
-        {'params': [p for n, p in param_optimizer if any(nd in n for nd in no_decay)], 'weight_decay': 0.0}]
+        {'params': decay_params, 'weight_decay': 0.01},
+        {'params': no_decay_params, 'weight_decay': 0.0}]
 
     if args.use_habana:
         if args.use_fused_lamb:
@@ -702,8 +1057,15 @@ def prepare_model_and_optimizer(args, device):
                 )
         else:
             if args.use_habana:
+                # one broadcast per dtype instead of one per parameter
+                params_by_dtype = collections.defaultdict(list)
                 for param in model.parameters():
-                    torch.distributed.broadcast(param.data, 0)
+                    params_by_dtype[param.dtype].append(param.data)
+                for params in params_by_dtype.values():
+                    flat = torch._utils._flatten_dense_tensors(params)
+                    torch.distributed.broadcast(flat, 0)
+                    for param, synced in zip(params, torch._utils._unflatten_dense_tensors(flat, params)):
+                        param.copy_(synced)
             else:
                 flat_dist_call([param.data for param in model.parameters()],
                                torch.distributed.broadcast, (0,))
@@ -711,6 +1073,9 @@ def prepare_model_and_optimizer(args, device):
         model = torch.nn.DataParallel(model)
 
     criterion = BertPretrainingCriterion(config.vocab_size)
+    if not args.use_habana:
+        # the HPU lazy mode already accumulates the loss ops into its graph
+        criterion = torch.jit.script(criterion)
 
     hooked_modules = [
         "bert.embeddings",
@@ -724,14 +1089,42 @@ def prepare_model_and_optimizer(args, device):
     return model, optimizer, lr_scheduler, checkpoint, global_step, criterion
 
 
-def take_optimizer_step(args, optimizer, model, overflow_buf, global_step):
+def take_optimizer_step_habana(args, optimizer, model, global_step,
+                               grad_buffer=None):
+    # In case of parameter tying allreduce was called twice for the
+    # parameters. Manually adding allreduce for the parameters.
+    if args.allreduce_post_accumulation:
+        grad_buffer.allreduce()
+
+    if args.hmp:
+        from habana_frameworks.torch.hpex import hmp
+        with hmp.disable_casts():
+            optimizer.step()
+    else:
+        optimizer.step()
+    if grad_buffer is not None:
+        grad_buffer.zero_()
+    else:
+        # NVLAMB and the hpex FusedLamb release the gradients by default,
+        # the latter takes no set_to_none argument
+        optimizer.zero_grad()
+    return global_step + 1
+
+
+def take_optimizer_step(args, optimizer, model, overflow_buf, global_step,
+                        grad_buffer=None, grad_divisor=None):
+    if args.use_habana:
+        return take_optimizer_step_habana(args, optimizer, model, global_step,
+                                          grad_buffer)
 
     global skipped_steps
-    if args.allreduce_post_accumulation and not args.use_habana:
+    if args.allreduce_post_accumulation:
         # manually allreduce gradients after all accumulation steps
         # check for Inf/NaN
         # 1. allocate an uninitialized buffer for flattened gradient
         loss_scale = _amp_state.loss_scalers[0].loss_scale() if args.fp16 else 1
+        if grad_divisor is None:
+            grad_divisor = utils.get_world_size() * args.gradient_accumulation_steps
         master_grads = [p.grad for p in amp.master_params(optimizer) if p.grad is not None]
         flat_grad_size = sum(p.numel() for p in master_grads)
         allreduce_dtype = torch.float16 if args.allreduce_post_accumulation_fp16 else torch.float32
@@ -743,8 +1136,7 @@ def take_optimizer_step(args, optimizer, model, overflow_buf, global_step):
             65536,
             overflow_buf,
             [master_grads, allreduced_views],
-            loss_scale / (
-                    utils.get_world_size() * args.gradient_accumulation_steps)
+            loss_scale / grad_divisor
         )
         # 3. sum gradient across ranks. Because of the predivision, this averages the gradient
         torch.distributed.all_reduce(flat_raw)
@@ -760,17 +1152,12 @@ def take_optimizer_step(args, optimizer, model, overflow_buf, global_step):
             old_overflow_buf = scaler._overflow_buf
             scaler._overflow_buf = overflow_buf
             had_overflow = scaler.update_scale()
-            scaler._overfloat_buf = old_overflow_buf
+            scaler._overflow_buf = old_overflow_buf
         else:
             had_overflow = 0
         # 6. call optimizer step function
         if had_overflow == 0:
-            if args.use_habana and args.hmp:
-                from habana_frameworks.torch.hpex import hmp
-                with hmp.disable_casts():
-                    optimizer.step()
-            else:
-                optimizer.step()
+            optimizer.step()
             global_step += 1
         else:
             # Overflow detected, print message and clear gradients
@@ -784,22 +1171,7 @@ def take_optimizer_step(args, optimizer, model, overflow_buf, global_step):
         for param in model.parameters():
             param.grad = None
     else:
-        # In case of parameter tying allreduce was called twice for the
-        # parameters. Manually adding allreduce for the parameters.
-        if args.use_habana and args.allreduce_post_accumulation:
-            grad_tensors = [param.grad for param in model.parameters() if param.grad is not None]
-            flat_tensor = torch.cat([t.contiguous().view(-1) for t in grad_tensors], dim=0)
-            flat_tensor.div_(float(torch.distributed.get_world_size() * args.gradient_accumulation_steps))
-            torch.distributed.all_reduce(flat_tensor)
-            outputs = unflatten_tensor(flat_tensor, grad_tensors)
-            updated_outputs = update_tensors(grad_tensors, outputs)
-
-        if args.use_habana and args.hmp:
-            from habana_frameworks.torch.hpex import hmp
-            with hmp.disable_casts():
-                optimizer.step()
-        else:
-            optimizer.step()
+        optimizer.step()
         #optimizer.zero_grad()
         for param in model.parameters():
             param.grad = None
@@ -808,6 +1180,36 @@ def take_optimizer_step(args, optimizer, model, overflow_buf, global_step):
     return global_step
 
 
+def checkpoint_to_cpu(state, copies=None):
+    if copies is None:
+        # tensors viewing the same memory, e.g. tied weights, are copied and saved once
+        copies = {}
+    if torch.is_tensor(state):
+        key = (state.device, state.data_ptr(), state.dtype,
+               tuple(state.shape), state.stride())
+        if key not in copies:
+            copies[key] = state.detach().to('cpu', copy=True)
+        return copies[key]
+    if isinstance(state, dict):
+        # a shallow copy keeps the dict type and attributes like _metadata
+        state = copy.copy(state)
+        for key, value in state.items():
+            state[key] = checkpoint_to_cpu(value, copies)
+        return state
+    if isinstance(state, (list, tuple)):
+        values = [checkpoint_to_cpu(value, copies) for value in state]
+        if hasattr(state, '_fields'):
+            return type(state)(*values)
+        return type(state)(values)
+    return state
+
+
+def save_checkpoint(checkpoint_dict, output_save_file, ckpt_to_be_removed=None):
+    torch.save(checkpoint_dict, output_save_file)
+    if ckpt_to_be_removed is not None:
+        os.remove(ckpt_to_be_removed)
+
+
 def get_metadata_file_path(input_dir: str) -> str:
     norm_path = os.path.normpath(input_dir)
     head_tail = os.path.split(norm_path)
@@ -852,7 +1254,18 @@ def main():
     np.random.seed(args.seed + args.local_rank)
     torch.manual_seed(args.seed + args.local_rank)
     torch.cuda.manual_seed(args.seed + args.local_rank)
-    worker_init = WorkerInitObj(args.seed + args.local_rank)
+    cpu_affinity = None
+    if args.bind_numa:
+        local_rank = int(os.getenv('OMPI_COMM_WORLD_LOCAL_RANK',
+                                   os.getenv('LOCAL_RANK', 0)))
+        cpu_affinity = utils.get_local_accelerator_cpus(local_rank)
+        if cpu_affinity is not None:
+            # bind before any runtime or process group threads are created
+            os.sched_setaffinity(0, cpu_affinity)
+        else:
+            warnings.warn('--bind_numa: could not find the NUMA node of '
+                          f'accelerator {local_rank}, affinity unchanged')
+    worker_init = WorkerInitObj(args.seed + args.local_rank, cpu_affinity)
     if args.enable_packed_data_mode:
         avg_seq_per_pack = read_avg_seq_per_sample(args.input_dir,
                                                    args.max_seq_length)
@@ -878,6 +1291,17 @@ def main():
 
     dllogger.log(step="PARAMETER", data={"Config": [str(args)]})
 
+    if args.drop_compute_sync_every < 1:
+        raise ValueError('Invalid drop_compute_sync_every parameter: '
+                         f'{args.drop_compute_sync_every}, should be >= 1')
+    global_drop_timer.sync_every = args.drop_compute_sync_every
+
+    # fixed for the whole run, keep them out of the per step path
+    world_size = utils.get_world_size()
+    rank = utils.get_rank()
+    main_process = rank == 0
+    grad_divisor = float(world_size * args.gradient_accumulation_steps)
+
     # Prepare optimizer
     (
         model,
@@ -912,25 +1336,40 @@ def main():
     training_steps = 0
     average_training_time_per_step = 0
     average_perf_per_step = 0
-    loss_list = []
+    # running sum of the step losses, read back once per log window
+    loss_accum = torch.zeros((), device=device)
 
     if device.type == 'cuda':
-        pool = ProcessPoolExecutor(1)
+        pool = ProcessPoolExecutor(args.prefetch_shards)
+    else:
+        # shards are loaded next to the HPU runtime instead of in a fork of it
+        pool = ThreadPoolExecutor(1)
+    # checkpoints are written in the background, one at a time
+    ckpt_pool = ThreadPoolExecutor(1)
+    ckpt_future = None
+
+    grad_buffer = None
+    if args.use_habana and args.allreduce_post_accumulation:
+        grad_buffer = FlatGradientBuffer(
+            model.parameters(),
+            grad_divisor,
+            args.allreduce_bucket_cap_mb,
+            args.allreduce_reduce_scatter)
 
     compute_state = ComputeState(device)
     starting_time = time.time()
     # loop infinitely over epochs, termination is handled via iteration count
-    time_logs = []
+    compute_logs = ComputeLogs(
+        max(args.steps_this_run - global_step, 0) * args.gradient_accumulation_steps)
+    # the shards do not change between epochs, only their order does
+    with os.scandir(args.input_dir) as entries:
+        # Packed files have no 'training' pre/postfix.
+        all_files = sorted(entry.path for entry in entries if entry.is_file() and (
+                args.enable_packed_data_mode or 'training' in entry.name))
     while True:
         restored_data_loader = None
         if not args.resume_from_checkpoint or epoch > 0 or (args.phase2 and global_step < 1) or args.init_checkpoint:
-            files = []
-            for file in os.listdir(args.input_dir):
-                if os.path.isfile(os.path.join(args.input_dir, file)):
-                    # Packed files have no 'training' pre/postfix.
-                    if args.enable_packed_data_mode or 'training' in file:
-                        files.append(os.path.join(args.input_dir, file))
-            files.sort()
+            files = list(all_files)
             num_files = len(files)
             random.Random(args.seed + epoch).shuffle(files)
             f_start_id = 0
@@ -945,28 +1384,24 @@ def main():
 
         shared_file_list = {}
 
-        if torch.distributed.is_initialized() and (
-                utils.get_world_size() > num_files):
-            remainder = utils.get_world_size() % num_files
-            data_file = files[(f_start_id * utils.get_world_size() + utils.get_rank() + remainder * f_start_id) % num_files]
-        else:
-            data_file = files[(f_start_id * utils.get_world_size() + utils.get_rank()) % num_files]
+        shard_schedule = get_shard_schedule(files, num_files)
+        data_file = shard_schedule[f_start_id]
 
         previous_file = data_file
 
+        if restored_data_loader is not None and not isinstance(
+                restored_data_loader.collate_fn, PretrainingBatchCollator):
+            # written before batches were collated into PretrainingBatch,
+            # the pickled dataset would yield plain lists
+            restored_data_loader = None
+
         if restored_data_loader is None:
-            num_workers = 0 if args.use_habana else 4
-            train_data = PretrainingDataset(data_file,
-                                            args.max_predictions_per_seq,
-                                            args.enable_packed_data_mode)
-            train_sampler = torch.utils.data.RandomSampler(train_data)
-            train_dataloader = torch.utils.data.DataLoader(
-                train_data, sampler=train_sampler,
-                batch_size=args.train_batch_size * args.n_pu,
-                num_workers=num_workers,
-                worker_init_fn=worker_init,
-                drop_last=True,
-                pin_memory=True
+            train_dataloader, _ = create_pretraining_dataset(
+                data_file,
+                args.max_predictions_per_seq,
+                shared_file_list,
+                args,
+                worker_init
             )
             # shared_file_list["0"] = (train_dataloader, data_file)
         else:
@@ -977,30 +1412,28 @@ def main():
         if args.allreduce_post_accumulation and not args.use_habana:
             overflow_buf = torch.cuda.IntTensor([0])
 
+        shard_prefetcher = ShardPrefetcher(pool,
+                                           args.prefetch_shards,
+                                           args.max_predictions_per_seq,
+                                           shared_file_list,
+                                           args,
+                                           worker_init)
         for f_id in range(f_start_id + 1, len(files)):
 
-            if utils.get_world_size() > num_files:
-                data_file = files[(f_id * utils.get_world_size() + utils.get_rank() + remainder * f_id) % num_files]
-            else:
-                data_file = files[(f_id * utils.get_world_size() + utils.get_rank()) % num_files]
+            data_file = shard_schedule[f_id]
 
             previous_file = data_file
 
-            if device.type == 'cuda':
-                dataset_future = pool.submit(create_pretraining_dataset,
-                                             data_file,
-                                             args.max_predictions_per_seq,
-                                             shared_file_list,
-                                             args,
-                                             worker_init)
+            # keep the next prefetch_shards shards loading while this one trains
+            for next_f_id in range(f_id, min(f_id + shard_prefetcher.prefetch, len(files))):
+                shard_prefetcher.submit(next_f_id, shard_schedule[next_f_id])
 
-            if utils.is_main_process():
+            train_iter = DevicePrefetcher(train_dataloader, device)
+            if main_process:
                 train_iter = tqdm(
-                    train_dataloader,
+                    train_iter,
                     desc="Iteration",
                     disable=args.disable_progress_bar)
-            else:
-                train_iter = train_dataloader
 
             if raw_train_start is None:
                 raw_train_start = time.time()
@@ -1009,17 +1442,20 @@ def main():
                 training_steps += 1
                 local_step = training_steps % args.gradient_accumulation_steps
                 is_optimizer_step = (local_step == 0)
-
-                batch = [t.to(device) for t in batch]
-                if args.enable_packed_data_mode:
-                    input_ids, segment_ids, input_mask, positions, masked_lm_labels, next_sentence_positions, next_sentence_labels = batch
-                else:
-                    input_ids, segment_ids, input_mask, masked_lm_labels, next_sentence_labels = batch
-                    next_sentence_positions = None
-                    positions = None
-
-                batch = input_mask.shape[0]
-                sentence_length = input_mask.shape[1]
+                DeviceTimer.begin_iteration()
+                if grad_buffer is not None and is_optimizer_step:
+                    grad_buffer.arm()
+
+                input_ids = batch.input_ids
+                segment_ids = batch.segment_ids
+                input_mask = batch.input_mask
+                masked_lm_labels = batch.masked_lm_labels
+                next_sentence_labels = batch.next_sentence_labels
+                # only present in packed data mode
+                positions = batch.positions
+                next_sentence_positions = batch.next_sentence_positions
+
+                batch, sentence_length = input_mask.shape[:2]
                 try:
                     if local_step == 1:
                         fwd_start = compute_state.start_compute
@@ -1073,32 +1509,44 @@ def main():
                         loss.backward()
                     compute_state.computed_batch_size += (
                         compute_state.mini_batch_size)
+                    compute_state.local_computed_batch_size += (
+                        compute_state.mini_batch_size)
                 except ComputeTimeout:
                     fwd_start = time.time()
                     is_optimizer_step = True  # just straight to all-reduce
                     if args.debug:
-                        print(f'Rank {utils.get_rank()} dropped '
+                        print(f'Rank {rank} dropped '
                               f'{local_step}/'
                               f'{args.gradient_accumulation_steps}')
                     pass
                 # End Compute
 
-                if args.use_lazy_mode and args.use_habana:
+                if args.use_lazy_mode and args.use_habana and not is_optimizer_step:
+                    # on optimizer steps the mark_step after the update closes this graph too
                     htcore.mark_step()  # not a blocking step
-                if torch.cuda.is_available():
-                    torch.cuda.synchronize()
 
-                loss_list.append(loss)
+                loss_accum += loss.detach()
                 if is_optimizer_step:
                     step_end = time.time()
                     lr_scheduler.step()  # learning rate warmup
-                    if torch.distributed.is_initialized():
+                    computed_batch_handle = None
+                    # bucket allreduces may already have been issued by the backward
+                    # hooks on some ranks only, the counter has to follow all of them
+                    reduce_after_step = grad_buffer is not None and bool(grad_buffer.buckets)
+                    if torch.distributed.is_initialized() and not reduce_after_step:
+                        # overlapped with the optimizer step, only read after it
+                        computed_batch_handle = torch.distributed.all_reduce(
+                            compute_state.computed_batch_size, async_op=True)
+                    global_step = take_optimizer_step(
+                        args, optimizer, model, overflow_buf, global_step,
+                        grad_buffer, grad_divisor)
+                    if torch.distributed.is_initialized() and reduce_after_step:
                         torch.distributed.all_reduce(
                             compute_state.computed_batch_size)
-                    global_step = take_optimizer_step(
-                        args, optimizer, model, overflow_buf, global_step)
-                    if utils.is_main_process() and args.debug:
-                        print(f'Rank {utils.get_rank()} STEP'
+                    if computed_batch_handle is not None:
+                        computed_batch_handle.wait()
+                    if main_process and args.debug:
+                        print(f'Rank {rank} STEP'
                               f' {global_step} compute logs '
                               f'{compute_state.computed_batch_size}')
                     if args.use_lazy_mode and args.use_habana:
@@ -1113,27 +1561,25 @@ def main():
                         enable_drop=(global_step > 5 and (
                                 compute_state.threshold > 0)),
                         start_compute=time.time(),
-                        mini_batch_size=len(input_ids)
+                        mini_batch_size=batch
                     )
                     if global_step == 6:
                         start_train_timestamp = time.time()
                 else:
-                    computed_batch = compute_state.computed_batch_size.item()
                     step_end = time.time()
                 if global_step > 5:
-                    time_logs.append((global_step,
-                                      local_step,
-                                      utils.get_world_size(),
-                                      batch,
-                                      sentence_length,
-                                      compute_state.computed_batch_size.item(),
-                                      compute_dropped,
-                                      fwd_start,
-                                      step_end))
+                    compute_logs.append(global_step=global_step,
+                                        local_step=local_step,
+                                        world_size=world_size,
+                                        batch=batch,
+                                        sentence_length=sentence_length,
+                                        computed_batch=compute_state.local_computed_batch_size,
+                                        compute_dropped=compute_dropped,
+                                        fwd_start=fwd_start,
+                                        step_end=step_end)
                 if global_step >= args.steps_this_run or timeout_sent or training_steps % (args.log_freq * args.gradient_accumulation_steps) == 0:
-                    for loss_t in loss_list:
-                        average_loss += loss_t.item()
-                    loss_list.clear()
+                    average_loss += loss_accum.item()
+                    loss_accum.zero_()
                     train_time = time.time() - starting_time
                     starting_time = time.time()
                     average_training_time_per_step = train_time/(args.gradient_accumulation_steps * args.log_freq)
@@ -1146,12 +1592,12 @@ def main():
                     average_loss = average_loss / (last_num_steps * divisor)
                     average_loss = torch.tensor(average_loss, dtype=torch.float32).to(device)
                     if torch.distributed.is_initialized():
-                        average_loss /= utils.get_world_size()
-                        torch.distributed.barrier()  # TODO(ngiladi): not necessary
-                        torch.distributed.all_reduce(average_loss)  # TODO(ngiladi): why necessary?
+                        average_loss /= world_size
+                        # averages the final loss over the ranks
+                        torch.distributed.all_reduce(average_loss)
                     final_loss = average_loss.item()
                     net_train_time = time.time() - start_train_timestamp
-                    if utils.is_main_process():
+                    if main_process:
                         dllogger.log(step=(epoch, global_step, ), data={
                             'final_loss':
                                 f'{final_loss:3.4}',
@@ -1163,7 +1609,7 @@ def main():
                                 f'{net_train_time:3.4f}'
                         })
                 elif training_steps % (args.log_freq * args.gradient_accumulation_steps) == 0:
-                    if utils.is_main_process():
+                    if main_process:
                         dllogger.log(step=(epoch, global_step, ), data={
                             'average_loss':
                                 f'{average_loss / (args.log_freq * divisor):3.4}',
@@ -1185,7 +1631,7 @@ def main():
                             torch.distributed.optim.ZeroRedundancyOptimizer
                     ):
                         optimizer.consolidate_state_dict()
-                    if utils.is_main_process() and not args.skip_checkpoint:
+                    if main_process and not args.skip_checkpoint:
                         # Save a trained model
                         dllogger.log(step="PARAMETER", data={"checkpoint_step": global_step})
                         model_to_save = model.module if hasattr(model,
@@ -1221,45 +1667,37 @@ def main():
                                     'epoch': epoch,
                                     'data_loader': None if global_step >= args.max_steps else train_dataloader}
 
-                            torch.save(checkpoint_dict, output_save_file)
+                            # snapshot before the next steps update the weights
+                            checkpoint_dict = checkpoint_to_cpu(checkpoint_dict)
                             most_recent_ckpts_paths.append(output_save_file)
+                            ckpt_to_be_removed = None
                             if len(most_recent_ckpts_paths) > 3:
                                 ckpt_to_be_removed = most_recent_ckpts_paths.pop(0)
-                                os.remove(ckpt_to_be_removed)
+                            if ckpt_future is not None:
+                                ckpt_future.result()
+                            ckpt_future = ckpt_pool.submit(save_checkpoint,
+                                                           checkpoint_dict,
+                                                           output_save_file,
+                                                           ckpt_to_be_removed)
 
                     # Exiting the training due to hitting max steps, or being sent a
                     # timeout from the cluster scheduler
                     if global_step >= args.steps_this_run or timeout_sent:
                         with open(os.path.join(
                                 args.log_dir,
-                                f'compute_logs_{utils.get_rank()}.csv'
+                                f'compute_logs_{rank}.csv'
                         ), 'w') as file:
-                             file.write(pd.DataFrame(time_logs, columns=(
-                                 'global_step',
-                                 'local_step',
-                                 'world_size',
-                                 'batch',
-                                 'sentence_length',
-                                 'computed_batch',
-                                 'compute_dropped',
-                                 'fwd_start',
-                                 'step_end'
-                             )).to_csv())
+                             file.write(compute_logs.to_csv())
+                        # the last checkpoint has to be on disk before exiting
+                        ckpt_pool.shutdown(wait=True)
+                        if ckpt_future is not None:
+                            ckpt_future.result()
                         del train_dataloader
                         return args, final_loss, train_time_raw, global_step
             del train_dataloader
             # Make sure pool has finished and switch train_dataloader
             # NOTE: Will block until complete
-            if device.type == 'cuda':
-                train_dataloader, data_file = dataset_future.result(timeout=None)
-            else:
-                train_dataloader, data_file = create_pretraining_dataset(
-                    data_file,
-                    args.max_predictions_per_seq,
-                    shared_file_list,
-                    args,
-                    worker_init
-                )
+            train_dataloader, data_file = shard_prefetcher.get(f_id)
         epoch += 1
 
 
@@ -11,6 +11,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import subprocess
 import torch
 import torch.distributed as dist
 
@@ -63,3 +65,87 @@ def mkdir_by_main_process(path):
     if is_main_process():
         mkdir(path)
     barrier()
+
+
+def parse_cpulist(cpulist):
+    cpus = set()
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def query_smi(command):
+    """Returns the csv rows printed by an hl-smi/nvidia-smi query, None if it is unavailable."""
+    try:
+        output = subprocess.run(command, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL,
+                                universal_newlines=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return [[field.strip() for field in line.split(',')]
+            for line in output.splitlines() if line.strip()]
+
+
+def normalize_pci_bus_id(bus_id):
+    # nvidia-smi prints an 8 digit domain, sysfs uses 4
+    domain, bus, function = bus_id.strip().lower().split(':')
+    return f'{domain[-4:].zfill(4)}:{bus}:{function}'
+
+
+def get_habana_bus_id(local_rank):
+    rows = query_smi(['hl-smi', '-Q', 'module_id,bus_id', '-f', 'csv,noheader'])
+    if not rows:
+        return None
+    bus_ids = {int(module_id): bus_id for module_id, bus_id in rows}
+    # ranks acquire the visible modules in order, module ids do not follow the PCI order
+    visible = os.getenv('HABANA_VISIBLE_MODULES')
+    if visible:
+        modules = [int(module_id) for module_id in visible.split(',') if module_id.strip()]
+    else:
+        modules = sorted(bus_ids)
+    if local_rank >= len(modules):
+        return None
+    return bus_ids.get(modules[local_rank])
+
+
+def get_cuda_bus_id(local_rank):
+    rows = query_smi(['nvidia-smi', '--query-gpu=index,uuid,pci.bus_id',
+                      '--format=csv,noheader'])
+    if not rows:
+        return None
+    visible = os.getenv('CUDA_VISIBLE_DEVICES')
+    if visible:
+        devices = [device.strip() for device in visible.split(',') if device.strip()]
+    else:
+        devices = [index for index, _, _ in rows]
+    if local_rank >= len(devices):
+        return None
+    # CUDA_VISIBLE_DEVICES holds indices or (prefixes of) uuids
+    for index, uuid, bus_id in rows:
+        if devices[local_rank] == index or uuid.startswith(devices[local_rank]):
+            return bus_id
+    return None
+
+
+def get_local_accelerator_cpus(local_rank):
+    """Returns the cpus of the NUMA node the local_rank-th visible accelerator is attached to, None if unknown."""
+    if local_rank < 0:
+        return None
+    bus_id = get_habana_bus_id(local_rank) or get_cuda_bus_id(local_rank)
+    if bus_id is None:
+        return None
+    try:
+        with open(os.path.join('/sys/bus/pci/devices',
+                               normalize_pci_bus_id(bus_id), 'numa_node')) as f:
+            numa_node = int(f.read())
+        if numa_node < 0:
+            return None
+        with open(f'/sys/devices/system/node/node{numa_node}/cpulist') as f:
+            cpus = parse_cpulist(f.read())
+    except (OSError, ValueError):
+        return None
+    # never widen the affinity the job was launched with
+    return cpus & os.sched_getaffinity(0) or None